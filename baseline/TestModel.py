@@ -9,9 +9,9 @@ import pandas as pd
 
 from data_utils.DataLoad import DataLoadDf
 from data_utils.Desed import DESED
-from evaluation_measures import psds_score, get_predictions, \
+from evaluation_measures import psds_score, get_strong_probabilities, decode_predictions, \
     compute_psds_from_operating_points, compute_metrics
-from utilities.utils import to_cuda_if_available, generate_tsv_wav_durations, meta_path_to_audio_dir
+from utilities.utils import to_cuda_if_available, generate_tsv_wav_durations, meta_path_to_audio_dir, load_state
 from utilities.ManyHotEncoder import ManyHotEncoder
 from utilities.Transforms import get_transforms
 from utilities.Logger import create_logger
@@ -23,7 +23,7 @@ logger = create_logger(__name__)
 torch.manual_seed(2020)
 
 
-def _load_crnn(state, model_name="model"):
+def _load_crnn(state, model_name="model", compile_model=False):
     crnn_args = state[model_name]["args"]
     crnn_kwargs = state[model_name]["kwargs"]
     crnn = CRNN(*crnn_args, **crnn_kwargs)
@@ -32,6 +32,12 @@ def _load_crnn(state, model_name="model"):
     crnn = to_cuda_if_available(crnn)
     logger.info("Model loaded at epoch: {}".format(state["epoch"]))
     logger.info(crnn)
+    if compile_model:
+        # torch.compile only exists for pytorch >= 2.0, the first batch is slower (compilation)
+        if hasattr(torch, "compile"):
+            crnn = torch.compile(crnn)
+        else:
+            logger.warning("torch.compile not available in this pytorch version, model not compiled")
     return crnn
 
 
@@ -48,19 +54,18 @@ def _load_scaler(state):
     return scaler
 
 
-def _load_state_vars(state, gtruth_df, median_win=None):
-    pred_df = gtruth_df.copy()
+def _load_state_vars(state, gtruth_df, median_win=None, compile_model=False):
     # Define dataloader
     many_hot_encoder = ManyHotEncoder.load_state_dict(state["many_hot_encoder"])
     scaler = _load_scaler(state)
-    crnn = _load_crnn(state)
+    crnn = _load_crnn(state, compile_model=compile_model)
     transforms_valid = get_transforms(cfg.max_frames, scaler=scaler, add_axis=0)
 
-    strong_dataload = DataLoadDf(pred_df, many_hot_encoder.encode_strong_df, transforms_valid, return_indexes=True)
-    strong_dataloader_ind = DataLoader(strong_dataload, batch_size=cfg.batch_size, drop_last=False)
+    strong_dataload = DataLoadDf(gtruth_df, many_hot_encoder.encode_strong_df, transforms_valid, return_indexes=True)
+    strong_dataloader_ind = DataLoader(strong_dataload, batch_size=cfg.batch_size, drop_last=False,
+                                       num_workers=cfg.num_workers, pin_memory=torch.cuda.is_available())
 
     pooling_time_ratio = state["pooling_time_ratio"]
-    many_hot_encoder = ManyHotEncoder.load_state_dict(state["many_hot_encoder"])
     if median_win is None:
         median_win = state["median_window"]
     return {
@@ -119,6 +124,11 @@ if __name__ == '__main__':
     parser.add_argument("-s", '--save_predictions_path', type=str, default=None,
                         help="Path for the predictions to be saved (if needed)")
 
+    parser.add_argument("--fp16", action="store_true", default=False,
+                        help="Make the forward pass of the model in half precision (only used if GPU available).")
+    parser.add_argument("--compile", action="store_true", default=False,
+                        help="Compile the model with torch.compile before inference (pytorch >= 2.0).")
+
     # Dev
     parser.add_argument("-n", '--nb_files', type=int, default=None,
                         help="Number of files to be used. Useful when testing on small number of files.")
@@ -128,17 +138,18 @@ if __name__ == '__main__':
     model_path, median_window, gt_audio_dir, groundtruth, durations = get_variables(f_args)
 
     # Model
-    expe_state = torch.load(model_path, map_location="cpu")
+    expe_state = load_state(model_path)
     dataset = DESED(base_feature_dir=osp.join(cfg.workspace, "dataset", "features"), compute_log=False)
 
     gt_df_feat = dataset.initialize_and_get_df(f_args.groundtruth_tsv, gt_audio_dir, nb_files=f_args.nb_files)
-    params = _load_state_vars(expe_state, gt_df_feat, median_window)
+    params = _load_state_vars(expe_state, gt_df_feat, median_window, compile_model=f_args.compile)
 
+    # Forward pass done once, the post processing is applied on these probabilities for every threshold
+    strong_probs = get_strong_probabilities(params["model"], params["dataloader"], fp16=f_args.fp16)
     # Preds with only one value
-    single_predictions = get_predictions(params["model"], params["dataloader"],
-                                         params["many_hot_encoder"].decode_strong, params["pooling_time_ratio"],
-                                         median_window=params["median_window"],
-                                         save_predictions=f_args.save_predictions_path)
+    single_predictions = decode_predictions(strong_probs, params["many_hot_encoder"].decode_strong,
+                                            params["pooling_time_ratio"], median_window=params["median_window"],
+                                            save_predictions=f_args.save_predictions_path)
     compute_metrics(single_predictions, groundtruth, durations)
 
     # ##########
@@ -148,10 +159,10 @@ if __name__ == '__main__':
     n_thresholds = 50
     # Example of 5 thresholds: 0.1, 0.3, 0.5, 0.7, 0.9
     list_thresholds = np.arange(1 / (n_thresholds * 2), 1, 1 / n_thresholds)
-    pred_ss_thresh = get_predictions(params["model"], params["dataloader"],
-                                     params["many_hot_encoder"].decode_strong, params["pooling_time_ratio"],
-                                     thresholds=list_thresholds, median_window=params["median_window"],
-                                     save_predictions=f_args.save_predictions_path)
+    pred_ss_thresh = decode_predictions(strong_probs, params["many_hot_encoder"].decode_strong,
+                                        params["pooling_time_ratio"], thresholds=list_thresholds,
+                                        median_window=params["median_window"],
+                                        save_predictions=f_args.save_predictions_path)
     psds = compute_psds_from_operating_points(pred_ss_thresh, groundtruth, durations)
     fname_roc = None
     if f_args.save_predictions_path is not None:
@@ -2,18 +2,16 @@
 import argparse
 import os
 import os.path as osp
-import scipy
 
-import torch
-from dcase_util.data import ProbabilityEncoder
 import pandas as pd
 import numpy as np
 
 from data_utils.DataLoad import DataLoadDf
 from data_utils.Desed import DESED
 from TestModel import _load_scaler, _load_crnn
-from evaluation_measures import psds_score, compute_psds_from_operating_points, compute_metrics
-from utilities.utils import to_cuda_if_available, generate_tsv_wav_durations, meta_path_to_audio_dir
+from evaluation_measures import psds_score, decode_predictions, compute_psds_from_operating_points, compute_metrics
+from utilities.utils import to_cuda_if_available, generate_tsv_wav_durations, meta_path_to_audio_dir, load_state, \
+    inference_context
 from utilities.ManyHotEncoder import ManyHotEncoder
 from utilities.Transforms import get_transforms
 from utilities.Logger import create_logger
@@ -26,38 +24,25 @@ def norm_alpha(x, alpha_val):
     return ((1 / x.shape[0]) * (x ** alpha_val).sum(0)) ** (1 / alpha_val)
 
 
-def get_predictions_ss_late_integration(model, valid_dataload, decoder, pooling_time_ratio=1, thresholds=[0.5],
-                                        median_window=1, save_predictions=None, alpha=1):
-    """ Get the predictions of a trained model on a specific set
+def get_strong_probabilities_ss_late_integration(model, valid_dataload, alpha=1, fp16=False):
+    """ Get the strong probabilities of a trained model on a specific set, combining the mixture and the sources
     Args:
         model: torch.Module, a trained pytorch model (you usually want it to be in .eval() mode).
         valid_dataload: DataLoadDf, giving ((input_data, label), index) but label is not used here, the multiple
             data are the multiple sources (the mixture should always be the first one to appear, and then the sources)
             example: if the input data is (3, 1, timesteps, freq) there is the mixture and 2 sources.
-        decoder: function, takes a numpy.array of shape (time_steps, n_labels) as input and return a list of lists
-            of ("event_label", "onset", "offset") for each label predicted.
-        pooling_time_ratio: the division to make between timesteps as input and timesteps as output
-        median_window: int, the median window (in number of time steps) to be applied
-        save_predictions: str or list, the path of the base_filename to save the predictions or a list of names
-            corresponding for each thresholds
-        thresholds: list, list of threshold to be applied
         alpha: float, the value of the norm to combine the predictions
+        fp16: bool, whether or not to make the forward pass in half precision (only if GPU available)
 
     Returns:
-        dict of the different predictions with associated threshold
+        dict, filename as key and the numpy.array of shape (time_steps, n_labels) of strong probabilities as value
     """
-
-    # Init a dataframe per threshold
-    prediction_dfs = {}
-    for threshold in thresholds:
-        prediction_dfs[threshold] = pd.DataFrame()
-
-    # Get predictions
+    strong_probabilities = {}
     for i, ((input_data, _), index) in enumerate(valid_dataload):
         input_data = to_cuda_if_available(input_data)
-        with torch.no_grad():
+        with inference_context(fp16):
             pred_strong, _ = model(input_data)
-        pred_strong = pred_strong.cpu()
+        pred_strong = pred_strong.float().cpu()
         pred_strong = pred_strong.detach().numpy()
         if i == 0:
             logger.debug(pred_strong)
@@ -65,72 +50,22 @@ def get_predictions_ss_late_integration(model, valid_dataload, decoder, pooling_
         pred_strong_sources = pred_strong[1:]
         pred_strong_sources = norm_alpha(pred_strong_sources, alpha)
         pred_strong_comb = norm_alpha(np.stack((pred_strong[0], pred_strong_sources), 0), alpha)
+        strong_probabilities[valid_dataload.filenames.iloc[index]] = pred_strong_comb
+    return strong_probabilities
+
 
-        # Get different post processing per threshold
-        for threshold in thresholds:
-            pred_strong_bin = ProbabilityEncoder().binarization(pred_strong_comb,
-                                                                binarization_type="global_threshold",
-                                                                threshold=threshold)
-            pred_strong_m = scipy.ndimage.filters.median_filter(pred_strong_bin, (median_window, 1))
-            pred = decoder(pred_strong_m)
-            pred = pd.DataFrame(pred, columns=["event_label", "onset", "offset"])
-            # Put them in seconds
-            pred.loc[:, ["onset", "offset"]] *= pooling_time_ratio / (cfg.sample_rate / cfg.hop_size)
-            pred.loc[:, ["onset", "offset"]] = pred[["onset", "offset"]].clip(0, cfg.max_len_seconds)
-
-            pred["filename"] = valid_dataload.filenames.iloc[index]
-            prediction_dfs[threshold] = prediction_dfs[threshold].append(pred, ignore_index=True)
-
-            if i == 0:
-                logger.debug("predictions: \n{}".format(pred))
-                logger.debug("predictions strong: \n{}".format(pred_strong_comb))
-
-    # Save predictions
-    if save_predictions is not None:
-        if isinstance(save_predictions, str):
-            if len(thresholds) == 1:
-                save_predictions = [save_predictions]
-            else:
-                base, ext = osp.splitext(save_predictions)
-                save_predictions = [osp.join(base, f"{threshold:.3f}{ext}") for threshold in thresholds]
-        else:
-            assert len(save_predictions) == len(thresholds), \
-                f"There should be a prediction file per threshold: len predictions: {len(save_predictions)}\n" \
-                f"len thresholds: {len(thresholds)}"
-            save_predictions = save_predictions
-
-        for ind, threshold in enumerate(thresholds):
-            dir_to_create = osp.dirname(save_predictions[ind])
-            if dir_to_create != "":
-                os.makedirs(dir_to_create, exist_ok=True)
-                if ind % 10 == 0:
-                    logger.info(f"Saving predictions at: {save_predictions[ind]}. {ind + 1} / {len(thresholds)}")
-                prediction_dfs[threshold].to_csv(save_predictions[ind], index=False, sep="\t", float_format="%.3f")
-
-    list_predictions = []
-    for key in prediction_dfs:
-        list_predictions.append(prediction_dfs[key])
-
-    if len(list_predictions) == 1:
-        list_predictions = list_predictions[0]
-
-    return list_predictions
-
-
-def _load_state_vars(state, gtruth_df, median_win=None):
-    pred_df = gtruth_df.copy()
+def _load_state_vars(state, gtruth_df, median_win=None, compile_model=False):
     # Define dataloader
     many_hot_encoder = ManyHotEncoder.load_state_dict(state["many_hot_encoder"])
     scaler = _load_scaler(state)
-    crnn = _load_crnn(state)
+    crnn = _load_crnn(state, compile_model=compile_model)
     # Note, need to unsqueeze axis 1
     transforms_valid = get_transforms(cfg.max_frames, scaler=scaler, add_axis=1)
 
     # Note, no dataloader here
-    strong_dataload = DataLoadDf(pred_df, many_hot_encoder.encode_strong_df, transforms_valid, return_indexes=True)
+    strong_dataload = DataLoadDf(gtruth_df, many_hot_encoder.encode_strong_df, transforms_valid, return_indexes=True)
 
     pooling_time_ratio = state["pooling_time_ratio"]
-    many_hot_encoder = ManyHotEncoder.load_state_dict(state["many_hot_encoder"])
     if median_win is None:
         median_win = state["median_window"]
     return {
@@ -197,6 +132,11 @@ if __name__ == '__main__':
     parser.add_argument("-s", '--save_predictions_path', type=str, default=None,
                         help="Path for the predictions to be saved (if needed)")
 
+    parser.add_argument("--fp16", action="store_true", default=False,
+                        help="Make the forward pass of the model in half precision (only used if GPU available).")
+    parser.add_argument("--compile", action="store_true", default=False,
+                        help="Compile the model with torch.compile before inference (pytorch >= 2.0).")
+
     # Dev only
     parser.add_argument("-n", '--nb_files', type=int, default=None,
                         help="Number of files to be used. Useful when testing on small number of files.")
@@ -205,22 +145,22 @@ if __name__ == '__main__':
     # Get variables from f_args
     model_path, median_window, gt_audio_dir, durations, keep_sources = get_variables(f_args)
 
-    expe_state = torch.load(model_path, map_location="cpu")
+    expe_state = load_state(model_path)
     dataset = DESED(base_feature_dir=os.path.join(cfg.workspace, "dataset", "features"), compute_log=False)
     groundtruth = pd.read_csv(f_args.groundtruth_tsv, sep="\t")
 
     gt_df_feat_ss = dataset.initialize_and_get_df(f_args.groundtruth_tsv, gt_audio_dir, f_args.base_dir_ss,
                                                   pattern_ss="_events", nb_files=f_args.nb_files,
                                                   keep_sources=keep_sources)
-    params = _load_state_vars(expe_state, gt_df_feat_ss, median_window)
+    params = _load_state_vars(expe_state, gt_df_feat_ss, median_window, compile_model=f_args.compile)
     alpha_norm = 1
-    # Preds with only one value (note that in comparison of TestModel, here we do not use a dataloader)
-    single_predictions = get_predictions_ss_late_integration(params["model"], params["dataload"],
-                                                             params["many_hot_encoder"].decode_strong,
-                                                             params["pooling_time_ratio"],
-                                                             median_window=params["median_window"],
-                                                             save_predictions=f_args.save_predictions_path,
-                                                             alpha=alpha_norm)
+    # Forward pass done once (note that in comparison of TestModel, here we do not use a dataloader)
+    strong_probs = get_strong_probabilities_ss_late_integration(params["model"], params["dataload"], alpha=alpha_norm,
+                                                                fp16=f_args.fp16)
+    # Preds with only one value
+    single_predictions = decode_predictions(strong_probs, params["many_hot_encoder"].decode_strong,
+                                            params["pooling_time_ratio"], median_window=params["median_window"],
+                                            save_predictions=f_args.save_predictions_path)
     compute_metrics(single_predictions, groundtruth, durations)
 
     # ##########
@@ -230,11 +170,9 @@ if __name__ == '__main__':
     n_thresholds = 50
     # Example of 5 thresholds: 0.1, 0.3, 0.5, 0.7, 0.9
     thresholds = np.arange(1 / (n_thresholds * 2), 1, 1 / n_thresholds)
-    pred_ss_thresh = get_predictions_ss_late_integration(params["model"], params["dataload"],
-                                                         params["many_hot_encoder"].decode_strong,
-                                                         params["pooling_time_ratio"],
-                                                         thresholds=thresholds,
-                                                         median_window=params["median_window"],
-                                                         save_predictions=f_args.save_predictions_path)
+    pred_ss_thresh = decode_predictions(strong_probs, params["many_hot_encoder"].decode_strong,
+                                        params["pooling_time_ratio"], thresholds=thresholds,
+                                        median_window=params["median_window"],
+                                        save_predictions=f_args.save_predictions_path)
     psds = compute_psds_from_operating_points(pred_ss_thresh, groundtruth, durations)
     psds_score(psds, filename_roc_curves=osp.splitext(f_args.save_predictions_path)[0] + "_roc.png")
@@ -8,6 +8,7 @@ from torch.utils.data import Dataset
 from torch.utils.data.sampler import Sampler
 
 from utilities.Logger import create_logger
+from utilities.utils import get_file_indexes
 import config as cfg
 from utilities.Transforms import Compose
 
@@ -43,6 +44,8 @@ class DataLoadDf(Dataset):
         self.return_indexes = return_indexes
         self.feat_filenames = df.feature_filename.drop_duplicates()
         self.filenames = df.filename.drop_duplicates()
+        # Row positions of each filename, computed when first getting strong labels (see get_sample)
+        self.filename_indexes = None
         self.in_memory = in_memory
         if self.in_memory:
             self.features = {}
@@ -108,7 +111,10 @@ class DataLoadDf(Dataset):
                         label = label.split(",")
             else:
                 cols = ["onset", "offset", "event_label"]
-                label = self.df[self.df.filename == self.filenames.iloc[index]][cols]
+                if self.filename_indexes is None:
+                    # Avoid comparing all the filenames of df for each sample
+                    self.filename_indexes = get_file_indexes(self.df)
+                label = self.df.take(self.filename_indexes[self.filenames.iloc[index]])[cols]
                 if label.empty:
                     label = []
         else:
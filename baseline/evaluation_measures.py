@@ -13,20 +13,25 @@ from psds_eval import plot_psd_roc, PSDSEval
 
 import config as cfg
 from utilities.Logger import create_logger
-from utilities.utils import to_cuda_if_available
+from utilities.utils import to_cuda_if_available, inference_context, get_file_indexes
 from utilities.ManyHotEncoder import ManyHotEncoder
 
 logger = create_logger(__name__, terminal_level=cfg.terminal_level)
 
 
-def get_event_list_current_file(df, fname):
+def get_event_list_current_file(df, fname, file_indexes=None):
     """
     Get list of events for a given filename
     :param df: pd.DataFrame, the dataframe to search on
     :param fname: the filename to extract the value from the dataframe
+    :param file_indexes: dict, (optional) row positions of each filename in df (see get_file_indexes),
+        avoids scanning the whole dataframe when called for every file
     :return: list of events (dictionaries) for the given filename
     """
-    event_file = df[df["filename"] == fname]
+    if file_indexes is None:
+        event_file = df[df["filename"] == fname]
+    else:
+        event_file = df.take(file_indexes.get(fname, np.empty(0, dtype=int)))
     if len(event_file) == 1:
         if pd.isna(event_file["event_label"].iloc[0]):
             event_list_for_current_file = [{"filename": fname}]
@@ -66,9 +71,11 @@ def event_based_evaluation_df(reference, estimated, t_collar=0.200, percentage_o
         empty_system_output_handling='zero_score'
     )
 
+    reference_indexes = get_file_indexes(reference)
+    estimated_indexes = get_file_indexes(estimated)
     for fname in evaluated_files:
-        reference_event_list_for_current_file = get_event_list_current_file(reference, fname)
-        estimated_event_list_for_current_file = get_event_list_current_file(estimated, fname)
+        reference_event_list_for_current_file = get_event_list_current_file(reference, fname, reference_indexes)
+        estimated_event_list_for_current_file = get_event_list_current_file(estimated, fname, estimated_indexes)
 
         event_based_metric.evaluate(
             reference_event_list=reference_event_list_for_current_file,
@@ -102,9 +109,11 @@ def segment_based_evaluation_df(reference, estimated, time_resolution=1.):
         time_resolution=time_resolution
     )
 
+    reference_indexes = get_file_indexes(reference)
+    estimated_indexes = get_file_indexes(estimated)
     for fname in evaluated_files:
-        reference_event_list_for_current_file = get_event_list_current_file(reference, fname)
-        estimated_event_list_for_current_file = get_event_list_current_file(estimated, fname)
+        reference_event_list_for_current_file = get_event_list_current_file(reference, fname, reference_indexes)
+        estimated_event_list_for_current_file = get_event_list_current_file(estimated, fname, estimated_indexes)
 
         segment_based_metric.evaluate(
             reference_event_list=reference_event_list_for_current_file,
@@ -114,12 +123,37 @@ def segment_based_evaluation_df(reference, estimated, time_resolution=1.):
     return segment_based_metric
 
 
-def get_predictions(model, dataloader, decoder, pooling_time_ratio=1, thresholds=[0.5],
-                    median_window=1, save_predictions=None):
-    """ Get the predictions of a trained model on a specific set
+def get_strong_probabilities(model, dataloader, fp16=False):
+    """ Get the strong probabilities (before any post processing) of a trained model on a specific set
     Args:
         model: torch.Module, a trained pytorch model (you usually want it to be in .eval() mode).
         dataloader: torch.utils.data.DataLoader, giving ((input_data, label), indexes) but label is not used here
+        fp16: bool, whether or not to make the forward pass in half precision (only if GPU available)
+
+    Returns:
+        dict, filename as key and the numpy.array of shape (time_steps, n_labels) of strong probabilities as value
+    """
+    strong_probabilities = {}
+    for i, ((input_data, _), indexes) in enumerate(dataloader):
+        indexes = indexes.numpy()
+        input_data = to_cuda_if_available(input_data)
+        with inference_context(fp16):
+            pred_strong, _ = model(input_data)
+        pred_strong = pred_strong.float().cpu()
+        pred_strong = pred_strong.detach().numpy()
+        if i == 0:
+            logger.debug(pred_strong)
+
+        for j, pred_strong_it in enumerate(pred_strong):
+            strong_probabilities[dataloader.dataset.filenames.iloc[indexes[j]]] = pred_strong_it
+    return strong_probabilities
+
+
+def decode_predictions(strong_probabilities, decoder, pooling_time_ratio=1, thresholds=[0.5],
+                       median_window=1, save_predictions=None):
+    """ Post process strong probabilities (see get_strong_probabilities) to get the predictions for each threshold
+    Args:
+        strong_probabilities: dict, filename as key and numpy.array of shape (time_steps, n_labels) as value
         decoder: function, takes a numpy.array of shape (time_steps, n_labels) as input and return a list of lists
             of ("event_label", "onset", "offset") for each label predicted.
         pooling_time_ratio: the division to make between timesteps as input and timesteps as output
@@ -132,41 +166,37 @@ def get_predictions(model, dataloader, decoder, pooling_time_ratio=1, thresholds
         dict of the different predictions with associated threshold
     """
 
-    # Init a dataframe per threshold
-    prediction_dfs = {}
+    # Init a list of dataframes (one per file) per threshold
+    prediction_lists = {}
     for threshold in thresholds:
-        prediction_dfs[threshold] = pd.DataFrame()
+        prediction_lists[threshold] = []
+    thresholds_arr = np.array(thresholds).reshape(-1, 1, 1)
+
+    # Post processing and put predictions in a dataframe
+    for j, (filename, pred_strong_it) in enumerate(strong_probabilities.items()):
+        # Binarization and median filter of all the thresholds at once, shape: (n_thresholds, time_steps, n_labels)
+        pred_strong_bin = np.array(pred_strong_it[np.newaxis] >= thresholds_arr, dtype=int)
+        pred_strong_m = scipy.ndimage.filters.median_filter(pred_strong_bin, (1, median_window, 1))
+        for ind, threshold in enumerate(thresholds):
+            pred = decoder(pred_strong_m[ind])
+            pred = pd.DataFrame(pred, columns=["event_label", "onset", "offset"])
+            pred["filename"] = filename
+            prediction_lists[threshold].append(pred)
 
-    # Get predictions
-    for i, ((input_data, _), indexes) in enumerate(dataloader):
-        indexes = indexes.numpy()
-        input_data = to_cuda_if_available(input_data)
-        with torch.no_grad():
-            pred_strong, _ = model(input_data)
-        pred_strong = pred_strong.cpu()
-        pred_strong = pred_strong.detach().numpy()
-        if i == 0:
-            logger.debug(pred_strong)
+            if j == 0:
+                logger.debug("predictions: \n{}".format(pred))
+                logger.debug("predictions strong: \n{}".format(pred_strong_it))
 
-        # Post processing and put predictions in a dataframe
-        for j, pred_strong_it in enumerate(pred_strong):
-            for threshold in thresholds:
-                pred_strong_bin = ProbabilityEncoder().binarization(pred_strong_it,
-                                                                    binarization_type="global_threshold",
-                                                                    threshold=threshold)
-                pred_strong_m = scipy.ndimage.filters.median_filter(pred_strong_bin, (median_window, 1))
-                pred = decoder(pred_strong_m)
-                pred = pd.DataFrame(pred, columns=["event_label", "onset", "offset"])
-                # Put them in seconds
-                pred.loc[:, ["onset", "offset"]] *= pooling_time_ratio / (cfg.sample_rate / cfg.hop_size)
-                pred.loc[:, ["onset", "offset"]] = pred[["onset", "offset"]].clip(0, cfg.max_len_seconds)
-
-                pred["filename"] = dataloader.dataset.filenames.iloc[indexes[j]]
-                prediction_dfs[threshold] = prediction_dfs[threshold].append(pred, ignore_index=True)
-
-                if i == 0 and j == 0:
-                    logger.debug("predictions: \n{}".format(pred))
-                    logger.debug("predictions strong: \n{}".format(pred_strong_it))
+    prediction_dfs = {}
+    for threshold in thresholds:
+        if len(prediction_lists[threshold]) == 0:
+            prediction_dfs[threshold] = pd.DataFrame()
+            continue
+        pred = pd.concat(prediction_lists[threshold], ignore_index=True)
+        # Put them in seconds
+        onset_offset = pred[["onset", "offset"]].astype(float) * pooling_time_ratio / (cfg.sample_rate / cfg.hop_size)
+        pred[["onset", "offset"]] = onset_offset.clip(0, cfg.max_len_seconds)
+        prediction_dfs[threshold] = pred
 
     # Save predictions
     if save_predictions is not None:
@@ -200,6 +230,28 @@ def get_predictions(model, dataloader, decoder, pooling_time_ratio=1, thresholds
     return list_predictions
 
 
+def get_predictions(model, dataloader, decoder, pooling_time_ratio=1, thresholds=[0.5],
+                    median_window=1, save_predictions=None):
+    """ Get the predictions of a trained model on a specific set
+    Args:
+        model: torch.Module, a trained pytorch model (you usually want it to be in .eval() mode).
+        dataloader: torch.utils.data.DataLoader, giving ((input_data, label), indexes) but label is not used here
+        decoder: function, takes a numpy.array of shape (time_steps, n_labels) as input and return a list of lists
+            of ("event_label", "onset", "offset") for each label predicted.
+        pooling_time_ratio: the division to make between timesteps as input and timesteps as output
+        median_window: int, the median window (in number of time steps) to be applied
+        save_predictions: str or list, the path of the base_filename to save the predictions or a list of names
+            corresponding for each thresholds
+        thresholds: list, list of threshold to be applied
+
+    Returns:
+        dict of the different predictions with associated threshold
+    """
+    strong_probabilities = get_strong_probabilities(model, dataloader)
+    return decode_predictions(strong_probabilities, decoder, pooling_time_ratio, thresholds=thresholds,
+                              median_window=median_window, save_predictions=save_predictions)
+
+
 def psds_score(psds, filename_roc_curves=None):
     """ add operating points to PSDSEval object and compute metrics
 
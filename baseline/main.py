@@ -16,7 +16,8 @@ from torch import nn
 from data_utils.Desed import DESED
 from data_utils.DataLoad import DataLoadDf, ConcatDataset, MultiStreamBatchSampler
 from TestModel import _load_crnn
-from evaluation_measures import get_predictions, psds_score, compute_psds_from_operating_points, compute_metrics
+from evaluation_measures import get_predictions, get_strong_probabilities, decode_predictions, psds_score, \
+    compute_psds_from_operating_points, compute_metrics
 from models.CRNN import CRNN
 import config as cfg
 from utilities import ramps
@@ -413,10 +414,12 @@ if __name__ == '__main__':
                                        num_workers=cfg.num_workers)
     validation_labels_df = dfs["validation"].drop("feature_filename", axis=1)
     durations_validation = get_durations_df(cfg.validation, cfg.audio_validation_dir)
+    # Forward pass done once, the post processing is applied on these probabilities for every threshold
+    valid_strong_probs = get_strong_probabilities(crnn, validation_dataloader)
     # Preds with only one value
-    valid_predictions = get_predictions(crnn, validation_dataloader, many_hot_encoder.decode_strong,
-                                        pooling_time_ratio, median_window=median_window,
-                                        save_predictions=predicitons_fname)
+    valid_predictions = decode_predictions(valid_strong_probs, many_hot_encoder.decode_strong,
+                                           pooling_time_ratio, median_window=median_window,
+                                           save_predictions=predicitons_fname)
     compute_metrics(valid_predictions, validation_labels_df, durations_validation)
 
     # ##########
@@ -426,8 +429,8 @@ if __name__ == '__main__':
     n_thresholds = 50
     # Example of 5 thresholds: 0.1, 0.3, 0.5, 0.7, 0.9
     list_thresholds = np.arange(1 / (n_thresholds * 2), 1, 1 / n_thresholds)
-    pred_ss_thresh = get_predictions(crnn, validation_dataloader, many_hot_encoder.decode_strong,
-                                     pooling_time_ratio, thresholds=list_thresholds, median_window=median_window,
-                                     save_predictions=predicitons_fname)
+    pred_ss_thresh = decode_predictions(valid_strong_probs, many_hot_encoder.decode_strong,
+                                        pooling_time_ratio, thresholds=list_thresholds, median_window=median_window,
+                                        save_predictions=predicitons_fname)
     psds = compute_psds_from_operating_points(pred_ss_thresh, validation_labels_df, durations_validation)
     psds_score(psds, filename_roc_curves=os.path.join(saved_pred_dir, "figures/psds_roc.png"))
@@ -2,6 +2,7 @@ from __future__ import print_function
 
 import glob
 import warnings
+from contextlib import contextmanager, ExitStack
 
 import numpy as np
 import pandas as pd
@@ -76,6 +77,65 @@ def to_cuda_if_available(*args):
     return res
 
 
+def get_file_indexes(df):
+    """ Get the row positions of each filename of a dataframe, computed once to be reused for each file
+    Args:
+        df: pd.DataFrame, the dataframe containing a "filename" column
+
+    Returns:
+        dict, filename as key and np.array of the row positions as value
+    """
+    return df.groupby("filename", sort=False).indices
+
+
+def load_state(model_path):
+    """ Load on cpu a state saved with torch.save (see main.py)
+    Args:
+        model_path: str, path of the saved state
+
+    Returns:
+        dict, the state
+    """
+    # The state contains non tensor objects (args, encoder, scaler) so weights_only is not possible
+    try:
+        # Memory map the tensors (pytorch >= 2.1) instead of copying the whole file in memory
+        return torch.load(model_path, map_location="cpu", mmap=True, weights_only=False)
+    except TypeError:
+        # pytorch < 2.1, mmap not available
+        pass
+    except RuntimeError as e:
+        # Legacy (not zipfile) serialization cannot be memory mapped, any other error is a real failure
+        if "mmap" not in str(e):
+            raise
+    try:
+        return torch.load(model_path, map_location="cpu", weights_only=False)
+    except TypeError:
+        # pytorch < 1.13, weights_only not available
+        return torch.load(model_path, map_location="cpu")
+
+
+@contextmanager
+def inference_context(fp16=False):
+    """ Context manager to use when making predictions with a model, no gradient is computed
+    Args:
+        fp16: bool, (Default value = False) whether or not to run operations in half precision (autocast),
+            only applied if GPU available
+    """
+    with ExitStack() as stack:
+        # torch.inference_mode (pytorch >= 1.9) is cheaper than torch.no_grad
+        if hasattr(torch, "inference_mode"):
+            stack.enter_context(torch.inference_mode())
+        else:
+            stack.enter_context(torch.no_grad())
+        if fp16 and torch.cuda.is_available():
+            if hasattr(torch, "autocast"):
+                stack.enter_context(torch.autocast("cuda", dtype=torch.float16))
+            else:
+                # pytorch < 1.10
+                stack.enter_context(torch.cuda.amp.autocast())
+        yield
+
+
 class SaveBest:
     """ Callback to get the best value and epoch
     Args: